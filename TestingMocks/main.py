@@ -1,33 +1,566 @@
 import uvicorn
-from fastapi import FastAPI, APIRouter, HTTPException, status, Body, File, UploadFile, Path
+from fastapi import FastAPI, APIRouter, HTTPException, status, Body, File, UploadFile, Path, Request, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+from collections import Counter
+from itertools import islice
+from operator import itemgetter, methodcaller
 import csv
+import hashlib
+import io
+import json
+import math
+import threading
+import time
+import uuid
 
-def parse_csv(csv_string):
+# Размер блока, которым читается загружаемый файл (хеш считается на лету).
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
-    data = []
+# Сколько самых частых значений колонки возвращать в статистике.
+TOP_K_VALUES = 5
+# Размер KMV-скетча для приближённого подсчёта уникальных значений.
+DISTINCT_SKETCH_SIZE = 256
+# Размер пачки строк при разборе CSV: статистика обновляется и прогресс
+# сообщается раз в пачку.
+INGEST_BATCH_ROWS = 4096
+# Результат соединения отдаётся пачками: не больше стольких строк или байт за раз.
+STREAM_BATCH_ROWS = 1000
+STREAM_BATCH_BYTES = 64 * 1024
+
+_HASH_SPACE = 2 ** 64
+
+
+def _to_numbers(values):
+    """Возвращает список конечных чисел для пачки строк или None.
+
+    None означает, что хотя бы одна строка не число; nan/inf и литералы
+    с подчёркиваниями (1_000) числами не считаются.
+    """
+    if "_" in "".join(values):
+        return None
+    try:
+        numbers = list(map(float, values))
+    except ValueError:
+        return None
+    if not all(map(math.isfinite, numbers)):
+        return None
+    return numbers
+
+
+def _number_from_text(text):
+    """Преобразует числовую строку в int, если она целая, иначе во float."""
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+class ColumnStats:
+    """Статистика одной колонки, накапливаемая за один проход по строкам.
+
+    Пустые значения считаются null. Число уникальных значений оценивается
+    KMV-скетчем (k минимальных хешей), частые значения - алгоритмом
+    Мисры-Гриса, поэтому память на колонку ограничена независимо от числа строк.
+    Значения принимаются пачками, чтобы основная работа выполнялась
+    встроенными функциями (min/max, map, Counter, sorted), а не кодом на
+    Python для каждого значения.
+    """
+
+    def __init__(self):
+        self.null_count = 0
+        self.numeric = True
+        self.min_number = None
+        self.max_number = None
+        self.min_string = None
+        self.max_string = None
+        self._min_number_text = None
+        self._max_number_text = None
+        self._sketch = []        # отсортированные k минимальных хешей
+        self._counters = {}      # счётчики Мисры-Гриса
+
+    def add_many(self, values):
+        non_null = list(filter(None, values))
+        self.null_count += len(values) - len(non_null)
+        if not non_null:
+            return
+
+        low, high = min(non_null), max(non_null)
+        if self.min_string is None or low < self.min_string:
+            self.min_string = low
+        if self.max_string is None or high > self.max_string:
+            self.max_string = high
+        if self.numeric:
+            numbers = _to_numbers(non_null)
+            if numbers is None:
+                self.numeric = False
+            else:
+                low, high = min(numbers), max(numbers)
+                if self.min_number is None or low < self.min_number:
+                    self.min_number = low
+                    self._min_number_text = non_null[numbers.index(low)]
+                if self.max_number is None or high > self.max_number:
+                    self.max_number = high
+                    self._max_number_text = non_null[numbers.index(high)]
+
+        # Counter вычисляет хеш каждой строки один раз и кэширует его в самой
+        # строке, поэтому скетч строится по уникальным значениям почти бесплатно.
+        chunk_counts = Counter(non_null)
+        hashes = map(hash, chunk_counts)
+        if len(self._sketch) == DISTINCT_SKETCH_SIZE:
+            # В скетч могут попасть только хеши меньше текущего k-го.
+            hashes = filter(self._sketch[-1].__gt__, hashes)
+        hashes = set(hashes)
+        if hashes:
+            hashes.update(self._sketch)
+            self._sketch = sorted(hashes)[:DISTINCT_SKETCH_SIZE]
+
+        limit = TOP_K_VALUES * 10
+        counters = self._counters
+        for value, count in self._reduce(chunk_counts, limit).items():
+            counters[value] = counters.get(value, 0) + count
+        self._counters = self._reduce(counters, limit)
+
+    @staticmethod
+    def _reduce(counters, limit):
+        """Сжатие сводки Мисры-Гриса до limit счётчиков."""
+        if len(counters) <= limit:
+            return counters
+        counts = sorted(counters.values(), reverse=True)
+        floor = counts[limit]
+        if floor == counts[0]:
+            return {}
+        return {value: count - floor for value, count in counters.items() if count > floor}
+
+    def approx_distinct(self):
+        if len(self._sketch) < DISTINCT_SKETCH_SIZE:
+            return len(self._sketch)
+        # hash() возвращает знаковое 64-битное значение; переводим его в (0, 1].
+        kth_smallest = (self._sketch[-1] + _HASH_SPACE // 2 + 1) / _HASH_SPACE
+        return round((DISTINCT_SKETCH_SIZE - 1) / kth_smallest)
+
+    def to_dict(self):
+        has_values = self.min_string is not None
+        numeric = has_values and self.numeric
+        top = sorted(self._counters.items(), key=lambda item: (-item[1], item[0]))
+        return {
+            "type": "numeric" if numeric else "string",
+            "null_count": self.null_count,
+            "min": _number_from_text(self._min_number_text) if numeric else self.min_string,
+            "max": _number_from_text(self._max_number_text) if numeric else self.max_string,
+            "approx_distinct": self.approx_distinct(),
+            "top_values": [
+                {"value": value, "count": count} for value, count in top[:TOP_K_VALUES]
+            ],
+        }
+
+
+def summarize_stats(columns, row_count):
+    """Собирает итоговую статистику набора из накопителей ColumnStats."""
+    return {
+        "row_count": row_count,
+        "columns": {name: column.to_dict() for name, column in columns.items()},
+    }
+
+
+def add_rows_to_stats(columns, rows):
+    """Передаёт пачку строк в накопители ColumnStats; отсутствующие значения - null."""
+    for col_name, column in columns.items():
+        try:
+            values = list(map(itemgetter(col_name), rows))
+        except KeyError:
+            values = list(map(methodcaller("get", col_name, ""), rows))
+        column.add_many(values)
+
+
+def iter_csv_rows(csv_string):
+    """Возвращает заголовок CSV и итератор по строкам в виде словарей."""
     lines = csv_string.strip().split("\n")
-    if not lines:
-        return data
-    
     reader = csv.reader(lines)
-    header = next(reader)
+    header = next(reader, [])
+    return header, (dict(zip(header, map(str.strip, row))) for row in reader)
+
 
-    for row in reader:
-        row_dict = {}
-        for col_name, value in zip(header, row):
-            row_dict[col_name] = value.strip()
-        data.append(row_dict)
-    return data
+def parse_csv_with_stats(csv_string, progress=None):
+    """Парсит CSV и за тот же проход собирает статистику по колонкам.
+
+    Возвращает пару (строки, статистика), где статистика -
+    {"row_count": ..., "columns": {имя_колонки: {...}}}.
+    Строки обрабатываются пачками по INGEST_BATCH_ROWS; если передан
+    progress, он вызывается с числом обработанных строк после каждой пачки.
+    Статистика строится по итоговым словарям строк: при повторяющихся
+    заголовках учитывается только сохранённое значение.
+    """
+    header, rows = iter_csv_rows(csv_string)
+    columns = {col_name: ColumnStats() for col_name in header}
+    data = []
+    while batch := list(islice(rows, INGEST_BATCH_ROWS)):
+        data.extend(batch)
+        add_rows_to_stats(columns, batch)
+        if progress is not None:
+            progress(len(data))
+    return data, summarize_stats(columns, len(data))
+
+
+def parse_csv(csv_string):
+    """Парсит CSV-строку в список словарей (без статистики)."""
+    _, rows = iter_csv_rows(csv_string)
+    return list(rows)
 
 
 registered_users = set()
 user_data_db = {}
 
+# Контентно-адресуемое хранилище: sha256 содержимого файла ->
+# {"data": распарсенный набор, "stats": статистика по колонкам,
+#  "refcount": число ссылок (username, dataset_name)}.
+# Распарсенные данные общие для всех ссылок и не должны изменяться.
+dataset_store = {}
+# (username, dataset_name) -> sha256 содержимого, на которое ссылается набор.
+dataset_refs = {}
+# (username, dataset_name) -> [последний выданный номер записи, номер опубликованной].
+# Номера выдаются в порядке поступления запросов, поэтому запись, закончившаяся
+# позже более новой, её не перезаписывает.
+dataset_generations = {}
+# Защищает dataset_store/dataset_refs: их меняют и обработчики, и фоновые задачи.
+store_lock = threading.RLock()
+
+
+def release_dataset(username, dataset_name):
+    """Снимает ссылку набора на общие данные и удаляет их, если ссылок больше нет."""
+    with store_lock:
+        digest = dataset_refs.pop((username, dataset_name), None)
+        if digest is None:
+            return
+        entry = dataset_store[digest]
+        entry["refcount"] -= 1
+        if entry["refcount"] == 0:
+            del dataset_store[digest]
+
+
+def user_has_content(username, digest):
+    """Проверяет, ссылается ли уже какой-либо набор этого пользователя на digest.
+
+    Учитываются только собственные наборы пользователя, чтобы ответ не выдавал,
+    загружал ли такое же содержимое кто-то другой.
+    """
+    with store_lock:
+        return any(
+            dataset_refs.get((username, name)) == digest for name in user_data_db[username]
+        )
+
+
+def begin_dataset_write(username, dataset_name):
+    """Выдаёт номер записи набора; публикация с меньшим номером не вытесняет большую."""
+    with store_lock:
+        generations = dataset_generations.setdefault((username, dataset_name), [0, 0])
+        generations[0] += 1
+        return generations[0]
+
+
+def store_dataset(username, dataset_name, digest, data_list=None, stats=None, generation=None):
+    """Привязывает набор пользователя к общим данным с хешем digest.
+
+    Если данных с таким хешем ещё нет, сохраняет переданные data_list и stats;
+    без data_list в этом случае ничего не делает и возвращает None.
+    generation - номер записи из begin_dataset_write; если уже опубликована
+    более новая запись, набор не меняется и возвращается None. Без generation
+    запись считается самой новой.
+    Возвращает общий (разделяемый) список строк. Набор становится виден
+    пользователю целиком, одной операцией под блокировкой.
+    """
+    with store_lock:
+        generations = dataset_generations.setdefault((username, dataset_name), [0, 0])
+        if generation is not None and generation < generations[1]:
+            return None
+        entry = dataset_store.get(digest)
+        if entry is None:
+            if data_list is None:
+                return None
+            entry = dataset_store[digest] = {"data": data_list, "stats": stats, "refcount": 0}
+        if generation is None:
+            generations[0] += 1
+            generation = generations[0]
+        generations[1] = generation
+        entry["refcount"] += 1
+        # Старую ссылку снимаем после новой: при повторной загрузке того же
+        # содержимого под тем же именем данные не должны успеть удалиться.
+        release_dataset(username, dataset_name)
+        dataset_refs[(username, dataset_name)] = digest
+        user_data_db[username][dataset_name] = entry["data"]
+        return entry["data"]
+
+
+# Фоновая загрузка: пул потоков для парсинга и состояние задач по job_id.
+ingest_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ingest")
+ingest_jobs = {}
+# Сколько секунд хранится завершённая задача и сколько задач хранится максимум.
+INGEST_JOB_TTL = 600
+MAX_INGEST_JOBS = 1000
+# Ограничение незавершённых (ожидающих и выполняемых) задач: каждая держит
+# в очереди пула всё содержимое файла.
+MAX_PENDING_INGEST_JOBS = 32
+MAX_PENDING_INGEST_JOBS_PER_CLIENT = 4
+# Клиент -> число его незавершённых задач.
+pending_ingest_jobs = {}
+ingest_jobs_lock = threading.Lock()
+
+
+def reserve_ingest_slot(client_key):
+    """Резервирует место под фоновую задачу клиента.
+
+    Возвращает None или код ответа, если лимит исчерпан: 429 для лимита
+    клиента, 503 для общего лимита сервера.
+    """
+    with ingest_jobs_lock:
+        pending = pending_ingest_jobs.get(client_key, 0)
+        if pending >= MAX_PENDING_INGEST_JOBS_PER_CLIENT:
+            return status.HTTP_429_TOO_MANY_REQUESTS
+        if sum(pending_ingest_jobs.values()) >= MAX_PENDING_INGEST_JOBS:
+            return status.HTTP_503_SERVICE_UNAVAILABLE
+        pending_ingest_jobs[client_key] = pending + 1
+        return None
+
+
+def release_ingest_slot(client_key):
+    with ingest_jobs_lock:
+        remaining = pending_ingest_jobs[client_key] - 1
+        if remaining:
+            pending_ingest_jobs[client_key] = remaining
+        else:
+            del pending_ingest_jobs[client_key]
+
+
+def prune_ingest_jobs(now):
+    """Удаляет завершённые задачи старше INGEST_JOB_TTL и лишние сверх MAX_INGEST_JOBS."""
+    finished = [
+        job for job in list(ingest_jobs.values()) if job["finished_at"] is not None
+    ]
+    for job in finished:
+        if now - job["finished_at"] > INGEST_JOB_TTL:
+            ingest_jobs.pop(job["job_id"], None)
+    excess = len(ingest_jobs) - MAX_INGEST_JOBS
+    if excess > 0:
+        finished = [job for job in finished if job["job_id"] in ingest_jobs]
+        finished.sort(key=lambda job: job["finished_at"])
+        for job in finished[:excess]:
+            ingest_jobs.pop(job["job_id"], None)
+
+
+def run_ingest_job(job, content):
+    """Парсит содержимое файла в фоновом потоке и публикует набор по завершении."""
+    job["state"] = "running"
+    job["started_at"] = time.monotonic()
+
+    def report_progress(rows):
+        job["rows_processed"] = rows
+
+    try:
+        data_list, stats = parse_csv_with_stats(content.decode('utf-8'), report_progress)
+        job["rows_processed"] = len(data_list)
+        published = store_dataset(
+            job["username"], job["dataset_name"], job["content_hash"], data_list, stats,
+            job["generation"]
+        )
+        # Если за время парсинга под этим именем уже сохранили более новые данные,
+        # результат задачи не публикуется.
+        job["state"] = "completed" if published is not None else "superseded"
+    except Exception as e:
+        job["error"] = f"Failed to process CSV file: {str(e)}"
+        job["state"] = "failed"
+    finally:
+        job["finished_at"] = time.monotonic()
+        release_ingest_slot(job["client"])
+
+
+def describe_job(job):
+    """Формирует публичное описание задачи загрузки."""
+    started_at = job["started_at"]
+    if started_at is None:
+        elapsed = 0.0
+    else:
+        elapsed = (job["finished_at"] or time.monotonic()) - started_at
+    return {
+        "job_id": job["job_id"],
+        "username": job["username"],
+        "dataset_name": job["dataset_name"],
+        "filename": job["filename"],
+        "state": job["state"],
+        "bytes_received": job["bytes_received"],
+        "rows_processed": job["rows_processed"],
+        "elapsed_seconds": round(elapsed, 6),
+        "rows_per_second": round(job["rows_processed"] / elapsed, 1) if elapsed > 0 else None,
+        "content_hash": job["content_hash"],
+        "deduplicated": job["deduplicated"],
+        "error": job["error"],
+    }
+
+class TokenBucket:
+    """Корзина токенов: ёмкость capacity, пополнение rate токенов в секунду."""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost):
+        """Сколько секунд ждать, пока в корзине наберётся cost токенов."""
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Ограничение частоты и числа одновременных запросов по клиентам.
+
+    Клиент - это вызывающая сторона (адрес подключения), а не пользователь
+    из пути запроса: иначе можно было бы расходовать чужие лимиты или
+    обходить свои, меняя имя в URL. У каждого клиента есть общая корзина
+    токенов и отдельная корзина на каждый маршрут; запрос проходит, только
+    если токенов хватает в обеих. Стоимость запроса растёт с размером тела,
+    поэтому крупная загрузка расходует больше токенов, чем запрос списка.
+    """
+
+    def __init__(
+        self,
+        client_capacity=60,
+        client_rate=20.0,
+        route_capacity=30,
+        route_rate=10.0,
+        max_concurrent=8,
+        bytes_per_token=64 * 1024,
+        sweep_threshold=1024,
+        route_costs=None,
+    ):
+        self.client_capacity = client_capacity
+        self.client_rate = client_rate
+        self.route_capacity = route_capacity
+        self.route_rate = route_rate
+        self.max_concurrent = max_concurrent
+        self.bytes_per_token = bytes_per_token
+        self.sweep_threshold = sweep_threshold
+        # (метод, путь маршрута) -> базовая стоимость запроса (по умолчанию 1).
+        self.route_costs = dict(route_costs or {})
+        self.reset()
+
+    def reset(self):
+        self.client_buckets = {}
+        self.route_buckets = {}
+        self.in_flight = {}
+        self._sweep_at = self.sweep_threshold
+
+    def request_cost(self, request, route_key):
+        try:
+            body_size = int(request.headers.get("content-length", 0))
+        except ValueError:
+            body_size = 0
+        return self.route_costs.get(route_key, 1) + body_size // self.bytes_per_token
+
+    def sweep(self, now):
+        """Удаляет заполненные корзины: они неотличимы от только что созданных."""
+        for buckets in (self.client_buckets, self.route_buckets):
+            idle = [
+                key for key, bucket in buckets.items()
+                if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity
+            ]
+            for key in idle:
+                del buckets[key]
+        # Следующая очистка - когда таблицы снова вырастут вдвое, поэтому
+        # её стоимость распределяется по запросам и в среднем постоянна.
+        size = len(self.client_buckets) + len(self.route_buckets)
+        self._sweep_at = max(self.sweep_threshold, 2 * size)
+
+    def acquire(self, client_key, route_key, cost):
+        """Пытается пропустить запрос. Возвращает None или время ожидания в секундах."""
+        if self.in_flight.get(client_key, 0) >= self.max_concurrent:
+            return 1.0
+
+        now = time.monotonic()
+        if len(self.client_buckets) + len(self.route_buckets) >= self._sweep_at:
+            self.sweep(now)
+
+        client_bucket = self.client_buckets.get(client_key)
+        if client_bucket is None:
+            client_bucket = self.client_buckets[client_key] = TokenBucket(
+                self.client_capacity, self.client_rate, now
+            )
+        route_bucket = self.route_buckets.get((client_key, route_key))
+        if route_bucket is None:
+            route_bucket = self.route_buckets[(client_key, route_key)] = TokenBucket(
+                self.route_capacity, self.route_rate, now
+            )
+        client_bucket.refill(now)
+        route_bucket.refill(now)
+
+        wait = max(client_bucket.wait_time(cost), route_bucket.wait_time(cost))
+        if wait > 0:
+            return wait
+
+        client_bucket.tokens -= min(cost, client_bucket.capacity)
+        route_bucket.tokens -= min(cost, route_bucket.capacity)
+        self.in_flight[client_key] = self.in_flight.get(client_key, 0) + 1
+        return None
+
+    def release(self, client_key):
+        remaining = self.in_flight[client_key] - 1
+        if remaining:
+            self.in_flight[client_key] = remaining
+        else:
+            del self.in_flight[client_key]
+
+
+rate_limiter = RateLimiter()
+
+
+class RateLimitedRoute(APIRoute):
+    """Маршрут, проверяющий лимиты клиента до чтения тела запроса.
+
+    Обработчик FastAPI читает тело (в том числе multipart-загрузку) раньше,
+    чем вызываются зависимости, поэтому проверка оборачивает сам обработчик:
+    отклонённый запрос не читается и не парсится.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def limited_handler(request: Request):
+            client_key = request.client.host if request.client else "anonymous"
+            route_key = (request.method, request.scope["route"].path)
+
+            retry_after = rate_limiter.acquire(client_key, route_key, rate_limiter.request_cost(request, route_key))
+            if retry_after is not None:
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Too many requests",
+                    headers={"Retry-After": str(math.ceil(retry_after))}
+                )
+            try:
+                return await handler(request)
+            finally:
+                rate_limiter.release(client_key)
+
+        return limited_handler
+
+
 router = APIRouter(
     prefix="/users",
     tags=["users_no_password"],
+    route_class=RateLimitedRoute,
 )
 
+
 @router.post("/register", status_code=status.HTTP_201_CREATED)
 async def register_user(username: str = Body(..., embed=True)): 
     """Регистрирует нового пользователя (без пароля)."""
@@ -41,13 +574,23 @@ async def register_user(username: str = Body(..., embed=True)):
     user_data_db[username] = {}    
     return {"message": "User registered successfully", "username": username}
 
-@router.post("/{username}/data/{dataset_name}", status_code=status.HTTP_200_OK)
+@router.post(
+    "/{username}/data/{dataset_name}",
+    status_code=status.HTTP_200_OK,
+    responses={202: {"description": "Upload accepted for background processing (background=true)"}},
+)
 async def upload_named_user_csv(
+    request: Request,
     username: str = Path(...), 
     dataset_name: str = Path(...), 
-    file: UploadFile = File(...) 
+    file: UploadFile = File(...),
+    background: bool = Query(False)
 ):
-    """Загружает CSV файл для пользователя."""
+    """Загружает CSV файл для пользователя.
+
+    С background=true отвечает 202 с job_id сразу после получения файла,
+    а парсинг выполняется в фоновом пуле (см. /{username}/jobs/{job_id}).
+    """
     if username not in registered_users: 
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -61,18 +604,74 @@ async def upload_named_user_csv(
         )
 
     try:
-        contents = await file.read()
-        decoded_content = contents.decode('utf-8') 
-        data_list = parse_csv(decoded_content)
+        hasher = hashlib.sha256()
+        chunks = []
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            chunks.append(chunk)
+        digest = hasher.hexdigest()
+
+        # Одинаковое содержимое парсится один раз и хранится в одном экземпляре.
+        deduplicated = user_has_content(username, digest)
+        data_list = store_dataset(username, dataset_name, digest)
+        reused = data_list is not None
+
+        if background:
+            client_key = request.client.host if request.client else "anonymous"
+            if not reused:
+                rejected = reserve_ingest_slot(client_key)
+                if rejected is not None:
+                    raise HTTPException(
+                        status_code=rejected,
+                        detail="Too many pending background uploads",
+                        headers={"Retry-After": "1"}
+                    )
+            job_id = uuid.uuid4().hex
+            now = time.monotonic()
+            prune_ingest_jobs(now)
+            job = ingest_jobs[job_id] = {
+                "job_id": job_id,
+                "username": username,
+                "dataset_name": dataset_name,
+                "filename": file.filename,
+                "state": "completed" if reused else "queued",
+                "bytes_received": sum(len(chunk) for chunk in chunks),
+                "rows_processed": len(data_list) if reused else 0,
+                "started_at": now if reused else None,
+                "finished_at": now if reused else None,
+                "content_hash": digest,
+                "deduplicated": deduplicated,
+                "generation": None if reused else begin_dataset_write(username, dataset_name),
+                "client": client_key,
+                "error": None,
+            }
+            if not reused:
+                ingest_executor.submit(run_ingest_job, job, b"".join(chunks))
+            return JSONResponse(
+                status_code=status.HTTP_202_ACCEPTED,
+                content={
+                    "message": f"Dataset '{dataset_name}' accepted for processing",
+                    "status_url": f"{router.prefix}/{username}/jobs/{job_id}",
+                    **describe_job(job)
+                }
+            )
+
+        if not reused:
+            decoded_content = b"".join(chunks).decode('utf-8')
+            data_list, stats = parse_csv_with_stats(decoded_content)
+            data_list = store_dataset(username, dataset_name, digest, data_list, stats)
 
-        user_data_db[username][dataset_name] = data_list
         return {
             "message": f"Dataset '{dataset_name}' uploaded successfully for user '{username}'",
             "username": username,
             "dataset_name": dataset_name,
             "filename": file.filename,
-            "rows_processed": len(data_list)
+            "rows_processed": len(data_list),
+            "content_hash": digest,
+            "deduplicated": deduplicated
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -81,6 +680,255 @@ async def upload_named_user_csv(
     finally:
         await file.close()
 
+@router.get("/{username}/jobs/{job_id}", status_code=status.HTTP_200_OK)
+async def get_ingest_job(username: str, job_id: str):
+    """Возвращает состояние и прогресс фоновой загрузки набора данных."""
+    if username not in registered_users:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+
+    job = ingest_jobs.get(job_id)
+    if job is None or job["username"] != username:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job '{job_id}' not found for user '{username}'"
+        )
+    return describe_job(job)
+
+class DatasetRef(BaseModel):
+    username: str
+    dataset_name: str
+
+
+class JoinRequest(BaseModel):
+    left: DatasetRef
+    right: DatasetRef
+    left_key: list[str]
+    right_key: list[str]
+    how: Literal["inner", "left"] = "inner"
+    columns: Optional[list[str]] = None
+    format: Literal["ndjson", "csv"] = "ndjson"
+    store_as: Optional[DatasetRef] = None
+
+
+def get_dataset_with_columns(ref):
+    """Возвращает (строки, колонки) набора или выбрасывает 404."""
+    if ref.username not in registered_users:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"User '{ref.username}' not found"
+        )
+    with store_lock:
+        digest = dataset_refs.get((ref.username, ref.dataset_name))
+        entry = dataset_store[digest] if digest is not None else None
+    if entry is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Dataset '{ref.dataset_name}' not found for user '{ref.username}'"
+        )
+    return entry["data"], list(entry["stats"]["columns"])
+
+
+def hash_join(left_rows, right_rows, left_key, right_key, how):
+    """Хеш-соединение двух наборов; хеш-таблица строится по меньшему из них.
+
+    Выдаёт кортежи (левая строка, правая строка или None). Для left join при
+    построении по левому набору строки без пары выдаются в конце.
+    Пустые и отсутствующие значения ключа считаются null и ни с чем не совпадают.
+    """
+    def key_of(row, key):
+        values = tuple(row.get(col, "") for col in key)
+        return None if "" in values else values
+
+    if len(right_rows) <= len(left_rows):
+        table = {}
+        for row in right_rows:
+            key = key_of(row, right_key)
+            if key is not None:
+                table.setdefault(key, []).append(row)
+        for left_row in left_rows:
+            key = key_of(left_row, left_key)
+            matches = table.get(key) if key is not None else None
+            if matches:
+                for right_row in matches:
+                    yield left_row, right_row
+            elif how == "left":
+                yield left_row, None
+    else:
+        table = {}
+        for index, row in enumerate(left_rows):
+            key = key_of(row, left_key)
+            if key is not None:
+                table.setdefault(key, []).append(index)
+        matched = bytearray(len(left_rows))
+        for right_row in right_rows:
+            key = key_of(right_row, right_key)
+            if key is None:
+                continue
+            for index in table.get(key, ()):
+                matched[index] = 1
+                yield left_rows[index], right_row
+        if how == "left":
+            for index, left_row in enumerate(left_rows):
+                if not matched[index]:
+                    yield left_row, None
+
+
+def joined_rows(join, left_rows, right_rows, right_columns, output_columns):
+    """Склеивает пары строк в словари с колонками output_columns.
+
+    right_columns - пары (колонка правого набора, имя в результате).
+    """
+    for left_row, right_row in hash_join(
+        left_rows, right_rows, join.left_key, join.right_key, join.how
+    ):
+        merged = dict(left_row)
+        if right_row is not None:
+            for col, name in right_columns:
+                merged[name] = right_row.get(col, "")
+        yield {col: merged.get(col, "") for col in output_columns}
+
+
+def format_rows(rows, output_columns, output_format):
+    """Сериализует строки в NDJSON или CSV пачками.
+
+    StreamingResponse обходит синхронный генератор через пул потоков, по
+    переходу на каждый элемент, поэтому строки собираются в пачки до
+    STREAM_BATCH_ROWS строк или STREAM_BATCH_BYTES символов.
+    """
+    buffer = io.StringIO()
+    if output_format == "ndjson":
+        def write_row(row):
+            buffer.write(json.dumps(row, ensure_ascii=False))
+            buffer.write("\n")
+    else:
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(output_columns)
+
+        def write_row(row):
+            writer.writerow([row[col] for col in output_columns])
+
+    batch_rows = 0
+    for row in rows:
+        write_row(row)
+        batch_rows += 1
+        if batch_rows >= STREAM_BATCH_ROWS or buffer.tell() >= STREAM_BATCH_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            batch_rows = 0
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def store_join_result(target, rows, output_columns):
+    """Сохраняет результат соединения как набор данных пользователя target.
+
+    Хеш считается по CSV-представлению результата, поэтому он дедуплицируется
+    с загрузкой такого же файла. Значения исходных наборов уже очищены
+    parse_csv_with_stats, так что разбор этого CSV дал бы те же строки, и
+    строки со статистикой берутся напрямую, без повторного парсинга.
+    """
+    data_list = list(rows)
+    columns = {col: ColumnStats() for col in output_columns}
+    for start in range(0, len(data_list), INGEST_BATCH_ROWS):
+        add_rows_to_stats(columns, data_list[start:start + INGEST_BATCH_ROWS])
+    hasher = hashlib.sha256()
+    for chunk in format_rows(data_list, output_columns, "csv"):
+        hasher.update(chunk.encode("utf-8"))
+    digest = hasher.hexdigest()
+    deduplicated = user_has_content(target.username, digest)
+    data_list = store_dataset(
+        target.username, target.dataset_name, digest,
+        data_list, summarize_stats(columns, len(data_list))
+    )
+    return {
+        "message": f"Dataset '{target.dataset_name}' stored for user '{target.username}'",
+        "username": target.username,
+        "dataset_name": target.dataset_name,
+        "rows_processed": len(data_list),
+        "content_hash": digest,
+        "deduplicated": deduplicated
+    }
+
+
+@router.post("/join", status_code=status.HTTP_200_OK)
+async def join_datasets(join: JoinRequest):
+    """Соединяет два набора данных по ключевым колонкам (inner/left hash join).
+
+    Результат отдаётся потоком в NDJSON или CSV, либо, если указан store_as,
+    сохраняется как новый набор данных.
+    """
+    left_rows, left_columns = get_dataset_with_columns(join.left)
+    right_rows, right_columns = get_dataset_with_columns(join.right)
+
+    if not join.left_key or len(join.left_key) != len(join.right_key):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="left_key and right_key must be non-empty and of equal length"
+        )
+    for key, columns, side in ((join.left_key, left_columns, "left"), (join.right_key, right_columns, "right")):
+        missing = [col for col in key if col not in columns]
+        if missing:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown {side} key columns: {', '.join(missing)}"
+            )
+
+    # Колонкам правого набора, совпадающим по имени с уже занятыми, подбирается
+    # свободное имя: right_<col>, затем right_<col>_2, right_<col>_3, ...
+    taken = set(left_columns)
+    renamed_right = []
+    for col in right_columns:
+        if col in join.right_key:
+            continue
+        name = col
+        if name in taken:
+            name = f"right_{col}"
+            suffix = 2
+            while name in taken:
+                name = f"right_{col}_{suffix}"
+                suffix += 1
+        taken.add(name)
+        renamed_right.append((col, name))
+    available = left_columns + [name for _, name in renamed_right]
+    output_columns = join.columns if join.columns is not None else available
+    if not output_columns or len(set(output_columns)) != len(output_columns):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Output columns must be non-empty and unique"
+        )
+    unknown = [col for col in output_columns if col not in available]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown output columns: {', '.join(unknown)}"
+        )
+
+    rows = joined_rows(join, left_rows, right_rows, renamed_right, output_columns)
+
+    if join.store_as is None:
+        media_type = "application/x-ndjson" if join.format == "ndjson" else "text/csv"
+        return StreamingResponse(format_rows(rows, output_columns, join.format), media_type=media_type)
+
+    target = join.store_as
+    if target.username not in registered_users:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"User '{target.username}' not found"
+        )
+    # Соединение, сериализация и статистика - долгая синхронная работа,
+    # поэтому она выполняется в пуле потоков, не блокируя цикл событий.
+    return await run_in_threadpool(store_join_result, target, rows, output_columns)
+
+
+# Соединение читает и перебирает два набора целиком, поэтому для лимитера
+# оно заметно дороже обычного запроса.
+JOIN_REQUEST_COST = 10
+rate_limiter.route_costs[("POST", f"{router.prefix}/join")] = JOIN_REQUEST_COST
+
 @router.get("/all", status_code=status.HTTP_200_OK)
 async def get_all_users():
     """Возвращает список имен всех зарегистрированных пользователей."""
@@ -116,6 +964,26 @@ async def get_named_user_data(username: str, dataset_name: str):
     user_specific_data = user_data_db[username][dataset_name]
     return user_specific_data
 
+@router.get("/{username}/data/{dataset_name}/stats", status_code=status.HTTP_200_OK)
+async def get_named_user_data_stats(username: str, dataset_name: str):
+    """Возвращает статистику по колонкам набора данных, собранную при загрузке."""
+    if username not in registered_users:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+
+    with store_lock:
+        digest = dataset_refs.get((username, dataset_name))
+        stats = dataset_store[digest]["stats"] if digest is not None else None
+    if stats is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Dataset '{dataset_name}' not found for user '{username}'"
+        )
+
+    return {"username": username, "dataset_name": dataset_name, **stats}
+
 app = FastAPI(
     title="Simple User Registration",
     description="ayaya",
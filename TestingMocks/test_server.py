@@ -1,7 +1,12 @@
+import json
+import time
+
 import pytest
+from fastapi import Request
 from fastapi.testclient import TestClient
 
-from .main import app, registered_users, user_data_db
+from . import main
+from .main import app, registered_users, user_data_db, dataset_store, dataset_refs, parse_csv, parse_csv_with_stats, rate_limiter, ingest_jobs, ingest_executor, dataset_generations, pending_ingest_jobs
 
 client = TestClient(app)
 
@@ -11,6 +16,12 @@ def clear_data_stores():
     """Очищает хранилища данных перед каждым тестом."""
     registered_users.clear()
     user_data_db.clear()
+    dataset_store.clear()
+    dataset_refs.clear()
+    rate_limiter.reset()
+    ingest_jobs.clear()
+    dataset_generations.clear()
+    pending_ingest_jobs.clear()
     yield 
 # Тесты для эндпоинта регистрации
 def test_register_new_user():
@@ -151,4 +162,430 @@ def test_get_named_user_data_success():
     response = client.get(f"/users/{username}/data/{dataset_name}")
     assert response.status_code == 200
     expected_data = [{"Key": "K1", "Value": "V1"}]
-    assert response.json() == expected_data
\ No newline at end of file
+    assert response.json() == expected_data
+
+# Тесты для дедупликации одинаковых загрузок
+def test_upload_identical_csv_is_shared_between_users():
+    client.post("/users/register", json={"username": "dedupA"})
+    client.post("/users/register", json={"username": "dedupB"})
+    csv_content = "ID,Name\n1,Alice"
+
+    first = client.post("/users/dedupA/data/ref", files={'file': ('ref.csv', csv_content, 'text/csv')})
+    second = client.post("/users/dedupB/data/table", files={'file': ('t.csv', csv_content, 'text/csv')})
+    assert first.json()["deduplicated"] is False
+    # Совпадение с чужим набором не раскрывается пользователю
+    assert second.json()["deduplicated"] is False
+    assert second.json()["rows_processed"] == 1
+    assert first.json()["content_hash"] == second.json()["content_hash"]
+
+    assert user_data_db["dedupA"]["ref"] is user_data_db["dedupB"]["table"]
+    assert len(dataset_store) == 1
+    assert dataset_store[first.json()["content_hash"]]["refcount"] == 2
+
+def test_upload_deduplicated_flag_reports_own_datasets_only():
+    client.post("/users/register", json={"username": "dedupD"})
+    files = {'file': ('a.csv', 'h\nv', 'text/csv')}
+    first = client.post("/users/dedupD/data/one", files=files)
+    second = client.post("/users/dedupD/data/two", files=files)
+    assert first.json()["deduplicated"] is False
+    assert second.json()["deduplicated"] is True
+
+def test_reupload_releases_unreferenced_content():
+    client.post("/users/register", json={"username": "dedupC"})
+    old = client.post("/users/dedupC/data/ds", files={'file': ('a.csv', 'h\nold', 'text/csv')})
+    client.post("/users/dedupC/data/ds", files={'file': ('a.csv', 'h\nold', 'text/csv')})
+    assert dataset_store[old.json()["content_hash"]]["refcount"] == 1
+
+    client.post("/users/dedupC/data/ds", files={'file': ('a.csv', 'h\nnew', 'text/csv')})
+    assert old.json()["content_hash"] not in dataset_store
+    assert len(dataset_store) == 1
+    assert user_data_db["dedupC"]["ds"] == [{"h": "new"}]
+
+# Тесты для статистики по колонкам
+def test_get_named_user_data_stats_success():
+    username = "statsuser"
+    client.post("/users/register", json={"username": username})
+    csv_content = "ID,Name,Value\n1,Apple,10\n2,Banana,\n3,Apple,8\n4,Cherry"
+    client.post(f"/users/{username}/data/fruits", files={'file': ('f.csv', csv_content, 'text/csv')})
+
+    response = client.get(f"/users/{username}/data/fruits/stats")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["row_count"] == 4
+    assert stats["columns"]["ID"] == {
+        "type": "numeric", "null_count": 0, "min": 1, "max": 4,
+        "approx_distinct": 4,
+        "top_values": [{"value": "1", "count": 1}, {"value": "2", "count": 1},
+                       {"value": "3", "count": 1}, {"value": "4", "count": 1}],
+    }
+    name = stats["columns"]["Name"]
+    assert name["type"] == "string"
+    assert (name["min"], name["max"]) == ("Apple", "Cherry")
+    assert name["approx_distinct"] == 3
+    assert name["top_values"][0] == {"value": "Apple", "count": 2}
+    value = stats["columns"]["Value"]
+    assert value["null_count"] == 2
+    assert (value["min"], value["max"]) == (8, 10)
+
+def test_get_named_user_data_stats_dataset_not_found():
+    client.post("/users/register", json={"username": "statsuser2"})
+    response = client.get("/users/statsuser2/data/nosuchdataset/stats")
+    assert response.status_code == 404
+
+def test_column_stats_ignore_non_finite_and_underscore_numbers():
+    client.post("/users/register", json={"username": "statsuser3"})
+    csv_content = "A,B,C\n1,nan,1_000\nnan,2,5\ninf,3,7"
+    client.post("/users/statsuser3/data/nums", files={'file': ('n.csv', csv_content, 'text/csv')})
+
+    response = client.get("/users/statsuser3/data/nums/stats")
+    assert response.status_code == 200
+    columns = response.json()["columns"]
+    assert columns["A"]["type"] == "string"
+    assert columns["B"]["type"] == "string"
+    assert columns["C"]["type"] == "string"
+    assert (columns["A"]["min"], columns["A"]["max"]) == ("1", "nan")
+
+def test_column_stats_duplicate_header_uses_stored_value():
+    data, stats = parse_csv_with_stats("a,a\n1,2")
+    assert data == [{"a": "2"}]
+    assert stats["columns"]["a"]["approx_distinct"] == 1
+    assert stats["columns"]["a"]["top_values"] == [{"value": "2", "count": 1}]
+
+def test_parse_csv_matches_rows_of_parse_csv_with_stats():
+    csv_content = "A,B\n1, x \n2\n3,y"
+    assert parse_csv(csv_content) == parse_csv_with_stats(csv_content)[0]
+    assert parse_csv(csv_content) == [{"A": "1", "B": "x"}, {"A": "2"}, {"A": "3", "B": "y"}]
+
+def test_column_stats_approx_distinct_large_column():
+    data, stats = parse_csv_with_stats("N\n" + "\n".join(str(i % 5000) for i in range(20000)))
+    assert len(data) == 20000
+    estimate = stats["columns"]["N"]["approx_distinct"]
+    assert 3500 < estimate < 6500
+
+# Тесты для ограничения частоты запросов
+@pytest.fixture
+def strict_limiter(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "client_capacity", 3)
+    monkeypatch.setattr(rate_limiter, "client_rate", 0.5)
+    monkeypatch.setattr(rate_limiter, "route_capacity", 2)
+    monkeypatch.setattr(rate_limiter, "route_rate", 0.5)
+    yield rate_limiter
+
+# Отдельные клиенты с разными адресами; регистрация идёт через общий client
+caller_a = TestClient(app, client=("10.0.0.1", 50000))
+caller_b = TestClient(app, client=("10.0.0.2", 50000))
+
+def test_rate_limit_per_route(strict_limiter):
+    client.post("/users/register", json={"username": "limited"})
+    assert caller_a.get("/users/limited/datasets").status_code == 200
+    assert caller_a.get("/users/limited/datasets").status_code == 200
+    response = caller_a.get("/users/limited/datasets")
+    assert response.status_code == 429
+    assert response.json() == {"detail": "Too many requests"}
+    assert int(response.headers["Retry-After"]) >= 1
+    # Другой маршрут того же клиента ещё в пределах общей корзины
+    assert caller_a.get("/users/limited/data/nosuchdataset").status_code == 404
+
+def test_rate_limit_is_per_caller(strict_limiter):
+    client.post("/users/register", json={"username": "userL1"})
+    client.post("/users/register", json={"username": "userL2"})
+    for _ in range(2):
+        caller_a.get("/users/userL1/datasets")
+    # Смена имени пользователя в пути не обходит лимит клиента
+    assert caller_a.get("/users/userL2/datasets").status_code == 429
+    # Другой клиент не затронут, даже обращаясь к тому же пользователю
+    assert caller_b.get("/users/userL1/datasets").status_code == 200
+
+def test_rate_limit_weights_upload_size(strict_limiter, monkeypatch):
+    client.post("/users/register", json={"username": "biguploader"})
+    monkeypatch.setattr(rate_limiter, "bytes_per_token", 16)
+    files = {'file': ('big.csv', "h\n" + "value\n" * 50, 'text/csv')}
+    assert caller_a.post("/users/biguploader/data/big", files=files).status_code == 200
+    # Крупная загрузка исчерпала общую корзину клиента
+    assert caller_a.get("/users/biguploader/datasets").status_code == 429
+
+def test_rate_limited_upload_rejected_before_body_is_read(strict_limiter, monkeypatch):
+    client.post("/users/register", json={"username": "earlyreject"})
+    # Три запроса исчерпывают общую корзину клиента (ёмкость 3)
+    caller_a.get("/users/all")
+    caller_a.get("/users/all")
+    assert caller_a.get("/users/earlyreject/datasets").status_code == 200
+
+    async def fail_form(self, *args, **kwargs):
+        raise AssertionError("form must not be parsed for a rejected request")
+    monkeypatch.setattr(Request, "form", fail_form)
+
+    files = {'file': ('d.csv', 'h\nv', 'text/csv')}
+    response = caller_a.post("/users/earlyreject/data/ds", files=files)
+    assert response.status_code == 429
+    assert "ds" not in user_data_db["earlyreject"]
+
+def test_rate_limit_concurrent_requests(strict_limiter, monkeypatch):
+    monkeypatch.setattr(rate_limiter, "max_concurrent", 1)
+    client.post("/users/register", json={"username": "busy"})
+    rate_limiter.in_flight["10.0.0.1"] = 1
+    response = caller_a.get("/users/busy/datasets")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+def test_rate_limit_evicts_idle_buckets(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "client_rate", 1e9)
+    monkeypatch.setattr(rate_limiter, "route_rate", 1e9)
+    monkeypatch.setattr(rate_limiter, "sweep_threshold", 16)
+    rate_limiter.reset()
+    for i in range(1000):
+        assert rate_limiter.acquire(f"10.1.{i // 256}.{i % 256}", ("GET", "/users/all"), 1) is None
+        rate_limiter.release(f"10.1.{i // 256}.{i % 256}")
+    assert len(rate_limiter.client_buckets) + len(rate_limiter.route_buckets) <= 32
+    assert rate_limiter.in_flight == {}
+
+# Тесты для фоновой загрузки
+def wait_for_job(username, job_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/users/{username}/jobs/{job_id}").json()
+        if job["state"] in ("completed", "failed", "superseded") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+def test_upload_csv_background_success():
+    username = "bguser"
+    client.post("/users/register", json={"username": username})
+    csv_content = "ID,Name\n" + "\n".join(f"{i},name{i}" for i in range(2500))
+    files = {'file': ('big.csv', csv_content, 'text/csv')}
+
+    response = client.post(f"/users/{username}/data/big?background=true", files=files)
+    assert response.status_code == 202
+    accepted = response.json()
+    assert accepted["state"] in ("queued", "running", "completed")
+    assert accepted["bytes_received"] == len(csv_content)
+    assert accepted["status_url"] == f"/users/{username}/jobs/{accepted['job_id']}"
+
+    job = wait_for_job(username, accepted["job_id"])
+    assert job["state"] == "completed"
+    assert job["rows_processed"] == 2500
+    assert job["error"] is None
+    assert len(user_data_db[username]["big"]) == 2500
+    assert client.get(f"/users/{username}/data/big/stats").json()["row_count"] == 2500
+
+def test_upload_csv_background_deduplicated_completes_immediately():
+    username = "bgdedup"
+    client.post("/users/register", json={"username": username})
+    files = {'file': ('d.csv', 'h\nv', 'text/csv')}
+    client.post(f"/users/{username}/data/first", files=files)
+
+    response = client.post(f"/users/{username}/data/second?background=true", files=files)
+    assert response.status_code == 202
+    assert response.json()["state"] == "completed"
+    assert response.json()["deduplicated"] is True
+    assert user_data_db[username]["second"] == [{"h": "v"}]
+
+def test_upload_csv_background_failure_reported():
+    username = "bgfail"
+    client.post("/users/register", json={"username": username})
+    files = {'file': ('bad.csv', b'\xff\xfe\x00', 'text/csv')}
+    response = client.post(f"/users/{username}/data/bad?background=true", files=files)
+    assert response.status_code == 202
+
+    job = wait_for_job(username, response.json()["job_id"])
+    assert job["state"] == "failed"
+    assert job["error"].startswith("Failed to process CSV file:")
+    assert "bad" not in user_data_db[username]
+
+def test_background_job_does_not_overwrite_newer_upload(monkeypatch):
+    username = "bgorder"
+    client.post("/users/register", json={"username": username})
+    submitted = []
+    monkeypatch.setattr(ingest_executor, "submit", lambda fn, *args: submitted.append((fn, args)))
+
+    old = {'file': ('d.csv', 'h\nold', 'text/csv')}
+    response = client.post(f"/users/{username}/data/ds?background=true", files=old)
+    assert response.status_code == 202
+    # Более поздняя синхронная загрузка завершается раньше фоновой задачи
+    new = {'file': ('d.csv', 'h\nnew', 'text/csv')}
+    client.post(f"/users/{username}/data/ds", files=new)
+
+    fn, args = submitted[0]
+    fn(*args)
+    job = client.get(f"/users/{username}/jobs/{response.json()['job_id']}").json()
+    assert job["state"] == "superseded"
+    assert user_data_db[username]["ds"] == [{"h": "new"}]
+    assert len(dataset_store) == 1
+
+def test_pending_background_uploads_are_capped(monkeypatch):
+    monkeypatch.setattr(main, "MAX_PENDING_INGEST_JOBS_PER_CLIENT", 2)
+    monkeypatch.setattr(main, "MAX_PENDING_INGEST_JOBS", 3)
+    submitted = []
+    monkeypatch.setattr(ingest_executor, "submit", lambda fn, *args: submitted.append((fn, args)))
+    client.post("/users/register", json={"username": "bgcap"})
+
+    def upload(caller, name):
+        files = {'file': ('d.csv', f'h\n{name}', 'text/csv')}
+        return caller.post(f"/users/bgcap/data/{name}?background=true", files=files)
+
+    assert upload(caller_a, "a1").status_code == 202
+    assert upload(caller_a, "a2").status_code == 202
+    rejected = upload(caller_a, "a3")
+    assert rejected.status_code == 429
+    assert rejected.json() == {"detail": "Too many pending background uploads"}
+    assert rejected.headers["Retry-After"] == "1"
+    assert upload(caller_b, "b1").status_code == 202
+    # Общий лимит сервера исчерпан
+    assert upload(caller_b, "b2").status_code == 503
+
+    # Завершение задачи освобождает место
+    fn, args = submitted[0]
+    fn(*args)
+    assert upload(caller_a, "a3").status_code == 202
+    assert pending_ingest_jobs == {"10.0.0.1": 2, "10.0.0.2": 1}
+
+def test_finished_ingest_jobs_are_pruned(monkeypatch):
+    monkeypatch.setattr(main, "MAX_INGEST_JOBS", 2)
+    username = "bgprune"
+    client.post("/users/register", json={"username": username})
+    files = {'file': ('d.csv', 'h\nv', 'text/csv')}
+    client.post(f"/users/{username}/data/first", files=files)
+    job_ids = [
+        client.post(f"/users/{username}/data/copy{i}?background=true", files=files).json()["job_id"]
+        for i in range(4)
+    ]
+    assert len(ingest_jobs) <= 3
+    assert job_ids[-1] in ingest_jobs
+    assert job_ids[0] not in ingest_jobs
+
+    monkeypatch.setattr(main, "INGEST_JOB_TTL", -1)
+    main.prune_ingest_jobs(time.monotonic())
+    assert ingest_jobs == {}
+
+def test_get_ingest_job_not_found():
+    client.post("/users/register", json={"username": "nojobuser"})
+    response = client.get("/users/nojobuser/jobs/unknown")
+    assert response.status_code == 404
+
+# Тесты для соединения наборов данных
+@pytest.fixture
+def join_datasets():
+    client.post("/users/register", json={"username": "joinA"})
+    client.post("/users/register", json={"username": "joinB"})
+    items = "ID,Name,Value\n1,Apple,10\n2,Banana,5\n3,Orange,8"
+    prices = "ItemID,Price,Value\n1,100,x\n3,300,y\n3,301,z\n4,400,w"
+    client.post("/users/joinA/data/items", files={'file': ('items.csv', items, 'text/csv')})
+    client.post("/users/joinB/data/prices", files={'file': ('prices.csv', prices, 'text/csv')})
+
+def join_payload(**overrides):
+    payload = {
+        "left": {"username": "joinA", "dataset_name": "items"},
+        "right": {"username": "joinB", "dataset_name": "prices"},
+        "left_key": ["ID"],
+        "right_key": ["ItemID"],
+    }
+    payload.update(overrides)
+    return payload
+
+def test_join_inner_ndjson(join_datasets):
+    response = client.post("/users/join", json=join_payload())
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows == [
+        {"ID": "1", "Name": "Apple", "Value": "10", "Price": "100", "right_Value": "x"},
+        {"ID": "3", "Name": "Orange", "Value": "8", "Price": "300", "right_Value": "y"},
+        {"ID": "3", "Name": "Orange", "Value": "8", "Price": "301", "right_Value": "z"},
+    ]
+
+def test_join_left_csv_with_projection(join_datasets):
+    payload = join_payload(how="left", columns=["ID", "Name", "Price"], format="csv")
+    response = client.post("/users/join", json=payload)
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0] == "ID,Name,Price"
+    assert sorted(lines[1:]) == ["1,Apple,100", "2,Banana,", "3,Orange,300", "3,Orange,301"]
+
+def test_join_store_as_new_dataset(join_datasets):
+    payload = join_payload(columns=["Name", "Price"], store_as={"username": "joinA", "dataset_name": "joined"})
+    response = client.post("/users/join", json=payload)
+    assert response.status_code == 200
+    assert response.json()["rows_processed"] == 3
+    assert user_data_db["joinA"]["joined"] == [
+        {"Name": "Apple", "Price": "100"},
+        {"Name": "Orange", "Price": "300"},
+        {"Name": "Orange", "Price": "301"},
+    ]
+    stats = client.get("/users/joinA/data/joined/stats").json()
+    assert stats["columns"]["Price"]["max"] == 301
+
+def test_hash_join_builds_on_smaller_side():
+    small = [{"k": "1", "side": "L1"}, {"k": "2", "side": "L2"}, {"k": "9", "side": "L9"}]
+    large = [{"k": "2", "side": "R2"}, {"k": "1", "side": "R1"}, {"k": "3", "side": "R3"}, {"k": "4", "side": "R4"}]
+
+    def sides(pairs):
+        return [(left["side"], right["side"] if right else None) for left, right in pairs]
+
+    # Таблица по левому (меньшему) набору: порядок задаёт правый набор,
+    # непарные левые строки left join выдаются в конце
+    assert sides(main.hash_join(small, large, ["k"], ["k"], "left")) == [
+        ("L2", "R2"), ("L1", "R1"), ("L9", None),
+    ]
+    # Таблица по правому (меньшему) набору: порядок задаёт левый набор
+    assert sides(main.hash_join(large, small, ["k"], ["k"], "left")) == [
+        ("R2", "L2"), ("R1", "L1"), ("R3", None), ("R4", None),
+    ]
+
+def test_join_renames_right_columns_to_unused_names():
+    client.post("/users/register", json={"username": "joinN"})
+    left = "K,Value,right_Value\n1,a,b"
+    right = "K,Value\n1,c"
+    client.post("/users/joinN/data/left", files={'file': ('l.csv', left, 'text/csv')})
+    client.post("/users/joinN/data/right", files={'file': ('r.csv', right, 'text/csv')})
+    payload = {
+        "left": {"username": "joinN", "dataset_name": "left"},
+        "right": {"username": "joinN", "dataset_name": "right"},
+        "left_key": ["K"], "right_key": ["K"],
+    }
+    response = client.post("/users/join", json=payload)
+    assert response.status_code == 200
+    assert json.loads(response.text) == {"K": "1", "Value": "a", "right_Value": "b", "right_Value_2": "c"}
+
+def test_join_costs_more_than_list_call(join_datasets, strict_limiter):
+    assert caller_a.get("/users/joinA/datasets").status_code == 200
+    assert caller_a.post("/users/join", json=join_payload()).status_code == 429
+    rate_limiter.reset()
+    assert caller_a.post("/users/join", json=join_payload()).status_code == 200
+    # Соединение израсходовало всю корзину клиента
+    assert caller_a.get("/users/joinA/datasets").status_code == 429
+
+def test_join_empty_keys_do_not_match():
+    client.post("/users/register", json={"username": "joinE"})
+    left = "K,L\n1,a\n,b\n2"
+    right = "K,R\n1,x\n,y\n3,z"
+    client.post("/users/joinE/data/left", files={'file': ('l.csv', left, 'text/csv')})
+    client.post("/users/joinE/data/right", files={'file': ('r.csv', right, 'text/csv')})
+    payload = {
+        "left": {"username": "joinE", "dataset_name": "left"},
+        "right": {"username": "joinE", "dataset_name": "right"},
+        "left_key": ["K"], "right_key": ["K"], "how": "left",
+    }
+    rows = [json.loads(line) for line in client.post("/users/join", json=payload).text.splitlines()]
+    assert sorted(rows, key=lambda row: (row["K"], row["L"])) == [
+        {"K": "", "L": "b", "R": ""},
+        {"K": "1", "L": "a", "R": "x"},
+        {"K": "2", "L": "", "R": ""},
+    ]
+    payload["how"] = "inner"
+    rows = [json.loads(line) for line in client.post("/users/join", json=payload).text.splitlines()]
+    assert rows == [{"K": "1", "L": "a", "R": "x"}]
+
+def test_join_streams_in_batches(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_BATCH_ROWS", 2)
+    chunks = list(main.format_rows(iter([{"a": str(i)} for i in range(5)]), ["a"], "csv"))
+    assert chunks == ["a\n0\n1\n", "2\n3\n", "4\n"]
+
+def test_join_unknown_key_column(join_datasets):
+    response = client.post("/users/join", json=join_payload(right_key=["Missing"]))
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Unknown right key columns: Missing"}
+
+def test_join_dataset_not_found(join_datasets):
+    payload = join_payload(right={"username": "joinB", "dataset_name": "nosuchdataset"})
+    response = client.post("/users/join", json=payload)
+    assert response.status_code == 404